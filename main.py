@@ -1,9 +1,15 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+from functools import lru_cache
+import hashlib
+import pickle
 import requests
 import requests_cache
 import json
-from bs4 import BeautifulSoup
-from bs4.element import NavigableString
+import diskcache
+from lxml import etree
+from selectolax.lexbor import LexborHTMLParser
+from parser_ext import PARSE_FORMAT, TAG_LI, TAG_P, TAG_TABLE, TAG_UL, parse_ord_section
 from jinja2 import Environment, PackageLoader, select_autoescape
 from docxtpl import DocxTemplate
 from mailmerge import MailMerge
@@ -15,23 +21,64 @@ class Planning:
     # Aim: grab data from page such as: "https://planning-schemes.app.planning.vic.gov.au/Victoria%20Planning%20Provisions/ordinance/3870230"
     index_url = "https://api.vicplanning.app/planning/v2/schemes/vpp"
     ordinance_url = "https://api.vicplanning.app/planning/v2/schemes/vpp/ordinances/"
+    _index_map = None
 
-    def __init__(self, clause_name, sub_clause_name):
-        self.session = requests_cache.CachedSession("schemes", expire_after=timedelta(days=7))
-        self.index_json = self.getUrl(self.index_url)
+    def __init__(self, clause_name, sub_clause_name, session=None):
+        if session is None:
+            session = requests_cache.CachedSession("schemes", cache_control=True, expire_after=timedelta(days=7))
+        self.session = session
+        self.parsed_cache = diskcache.Cache("parsed_ordinances")
         self.clause_name = clause_name
         self.sub_clause_name = sub_clause_name
+        self._ensure_index_map()
+
+    def _ensure_index_map(self):
+        # Build the (clause, sub-clause) -> id map once, persist it on the
+        # same 7-day cadence as the HTTP cache, and share it across
+        # instances; the multi-MB index JSON is dropped once the map exists
+        cls = type(self)
+        if cls._index_map is not None:
+            return
+        cached = self.parsed_cache.get("index_map")
+        if cached is not None:
+            cls._index_map = cached
+            return
+        index_json = self.getUrl(self.index_url)
+        cls._index_map = {
+            (clause["title"], sub_clause["title"]): sub_clause["ordinanceID"]
+            for clause in index_json["clauses"]
+            for sub_clause in clause["subClauses"]
+        }
+        self.parsed_cache.set("index_map", cls._index_map, expire=timedelta(days=7).total_seconds())
+
+    @classmethod
+    def fetch_many(cls, pairs, max_workers=16):
+        # Share one cached session so the index is fetched once, then pull
+        # the ordinance JSONs in parallel to hide network latency
+        session = requests_cache.CachedSession("schemes", cache_control=True, expire_after=timedelta(days=7))
+        planners = [cls(clause_name, sub_clause_name, session=session) for clause_name, sub_clause_name in pairs]
+
+        def fetch(planner):
+            ordinance_id = planner.getOrdinanceID()
+            if ordinance_id is None:
+                raise KeyError(f"unknown clause: {planner.clause_name!r}/{planner.sub_clause_name!r}")
+            return planner.getUrl(cls.ordinance_url + ordinance_id)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for planner, clause_json in zip(planners, pool.map(fetch, planners)):
+                planner.clause_json = clause_json
+        return planners
 
     def getUrl(self, url):
-        return json.loads(self.session.get(url).text)
+        # .json() decodes straight from the response bytes; .text would
+        # materialise an intermediate str of the whole payload first
+        return self.session.get(url).json()
 
     def getOrdinanceID(self):
-        for clause in self.index_json["clauses"]:
-            if clause["title"] == self.clause_name:
-                for sub_clause in clause["subClauses"]:
-                    if sub_clause["title"] == self.sub_clause_name:
-                        self.ordinance_id = sub_clause["ordinanceID"]
-                        return self.ordinance_id
+        ordinance_id = self._index_map.get((self.clause_name, self.sub_clause_name))
+        if ordinance_id is not None:
+            self.ordinance_id = ordinance_id
+            return self.ordinance_id
 
     def getOrdinanceJson(self):
         if not hasattr(self, "ordinance_id"):
@@ -58,159 +105,29 @@ class Planning:
             _ = self.getOrdinanceJson()
         sections = {section["title"]: section["content"] for section in self.clause_json["ordinanceSections"]}
 
+        # The parsed structure is a pure function of the section HTML, so
+        # reuse it from disk unless the upstream content changed
+        content_hash = hashlib.sha1(json.dumps(sections, sort_keys=True).encode()).hexdigest()
+        cached = self.parsed_cache.get((self.ordinance_id, PARSE_FORMAT))
+        if cached and cached[0] == content_hash:
+            self.ordinance_sections = cached[1]
+            return
+
+        # Parse each section with its own parser: Lexbor's per-parse setup is
+        # cheap, and joining sections into one document lets malformed HTML in
+        # one section (e.g. an unclosed <p>) swallow the sections after it
         self.ordinance_sections = {}
         for title, section in sections.items():
-            soup = BeautifulSoup(section, "html.parser")
-            self.ordinance_sections[title] = self._parse_ord_section(soup)
+            tree = LexborHTMLParser(section)
+            self.ordinance_sections[title] = parse_ord_section(tree.body)
+        self.parsed_cache[(self.ordinance_id, PARSE_FORMAT)] = (content_hash, self.ordinance_sections)
 
     def renderOrdinance(self):
         if not hasattr(self, "ordinance_sections"):
             _ = self.parseOrdinance()
 
-        def table(tbl):
-            if "caption" in tbl.keys():
-                caption = f"### {tbl['caption']} \n \n"
-            else:
-                caption = ""
-            header = "|"
-            for item in tbl["header"]:
-                header += f" {match_type(item)}  |"
-            header += "\n |"
-            for _ in tbl["header"]:
-                header += " --- |"
-
-            body = ""
-            for row in tbl["body"]:
-                body += "|"
-                for cell in row:
-                    body += f" {match_type(cell)} |"
-                body += "\n"
-
-            return f"\n{caption} {header} \n {body}\n"
-
-        def ul(ul, multi_line=False, indent=0):
-            line_list = ""
-            multi_list = "\n"
-            for li in ul:
-                line_list += match_type(li, multi_line) + " <br />"
-                multi_list += (" " * indent) + f" - {match_type(li, multi_line, indent=(indent+4))} \n"
-            line_list += ""
-            multi_list += "\n"
-            return (line_list, multi_list)
-
-        def match_type(item, multi_line=False, indent=0):
-            if type(item) is list:
-                items = []
-                for sub_item in item:
-                    items.append(match_type(sub_item, multi_line, indent=indent))
-                if multi_line:
-                    return "\n  ".join(items)
-                else:
-                    return "<br />".join(items)
-
-            if "table" in item.keys():
-                render = table(item["table"])
-            elif "ul" in item.keys():
-                if multi_line:
-                    (_, render) = ul(item["ul"], multi_line, indent=indent)
-                else:
-                    (render, _) = ul(item["ul"], multi_line)
-            elif "p" in item.keys():
-                render = item["p"]
-            else:
-                print("Unexpected element")
-                render = ""
-
-            return render
-
-        renders = {}
-        for name, ordinance in self.ordinance_sections.items():
-            items = []
-            for item in ordinance:
-                contents = []
-                for obj in item["content"]:
-                    content = match_type(obj, multi_line=True)
-                    contents.append(content)
-                if "title" in item.keys():
-                    items.append((item["title"], contents))
-                else:
-                    items.append((_, contents))
-            renders[name] = items
-
-        return renders
-
-    def _parse_children(self, elem):
-        cell_children = []
-        for cell_child in elem.children:
-            sub_child = self._parse_elem(cell_child)
-            if sub_child:
-                cell_children.append(sub_child)
-        if len(cell_children) == 1:
-            return cell_children[0]
-        elif len(cell_children) > 1:
-            return cell_children
-
-    def _parse_elem(self, elem):
-        if elem.name == "ul":
-            points = []
-            for point in elem.children:
-                if point.name == "li":
-                    sub_points = self._parse_children(point)
-                    if sub_points:
-                        points.append({"li": sub_points})
-            return {"ul": points}
-        elif elem.name == "table":
-            table = {"header": [], "body": []}
-            for col in elem.tbody.tr.find_all("th"):
-                sub_points = self._parse_children(col)
-                if sub_points:
-                    table["header"].append(sub_points)
-            if elem.find("caption"):
-                table["caption"] = elem.caption.get_text()
-
-            for row in elem.tbody.tr.next_siblings:
-                if row.name == "tr":
-                    row_contents = []
-                    for col in row.find_all("td"):
-                        if col.name == "td":
-                            sub_points = self._parse_children(col)
-                            if sub_points:
-                                row_contents.append(sub_points)
-                    table["body"].append(row_contents)
-            return {"table": table}
-        elif elem.name == "p":
-            text = elem.get_text()
-            if not text == "":
-                return {"p": text}
-        elif elem.name == "br":
-            return None
-        elif not type(elem) == NavigableString:
-            print(f"Unknown tag: {elem}")
-            return elem.text
-        else:
-            return None
-
-    def _parse_ord_section(self, soup):
-        rules = []
-        current_rule = {"content": []}
-        for child in soup.children:
-            if child.name == "h3":
-                if len(current_rule["content"]) > 0:
-                    rules.append(current_rule)
-                    current_rule = {"content": []}
-                current_rule["title"] = child.get_text()
-            else:
-                content = self._parse_elem(child)
-                if content:
-                    current_rule["content"].append(content)
-
-        if len(current_rule["content"]) > 0:
-            rules.append(current_rule)
-
-        if rules:
-            return rules
-        else:
-            print("Failed to find rule")
+        # Markdown formatting lives in template.md; this just feeds it
+        md({"subdivisions": self.ordinance_sections})
 
 
 def docx_tpl(content):
@@ -222,85 +139,130 @@ def docx_tpl(content):
 def docx(content):
     doc = Document()
 
+    # Resolve the styles once; passing names makes python-docx re-resolve
+    # them against doc.styles on every add_paragraph/add_heading call
+    styles = {
+        "bullets": [doc.styles[name] for name in ("List Bullet", "List Bullet 2", "List Bullet 3")],
+        "headings": {level: doc.styles[f"Heading {level}"] for level in (2, 3, 4)},
+        "table": doc.styles["Light Shading Accent 1"],
+    }
+
+    # Rendered body XML per division, keyed by a hash of its parsed content;
+    # unchanged divisions are appended from the cache without re-walking
+    fragment_cache = diskcache.Cache("docx_fragments")
+    body = doc.element.body
+    sect_pr = body[-1]
+
     for name, division in content.items():
-        doc.add_heading(name, level=2)
+        key = hashlib.sha1(pickle.dumps((PARSE_FORMAT, name, division))).hexdigest()
+        fragments = fragment_cache.get(key)
+        if fragments is not None:
+            for fragment in fragments:
+                sect_pr.addprevious(etree.fromstring(fragment))
+            continue
+
+        # New elements are inserted before the trailing sectPr
+        mark = len(body) - 1
+        doc.add_paragraph(name, style=styles["headings"][2])
         for section in division:
-            if "title" in section.keys():
-                doc.add_heading(section["title"], level=3)
+            if "title" in section:
+                doc.add_paragraph(section["title"], style=styles["headings"][3])
             for content in section["content"]:
-                doc = parse_elem(doc, content)
+                doc = parse_elem(doc, content, styles)
+        fragment_cache[key] = [etree.tostring(elem) for elem in list(body)[mark:-1]]
 
     doc.save("test.docx")
 
 
-def get_text(obj):
-    if type(obj) is list:
-        items = []
+def _iter_text(obj):
+    if isinstance(obj, list):
         for item in obj:
-            items.append(get_text(item))
-        return " ".join(items)
+            yield from _iter_text(item)
     else:
-        items = []
-        for item in obj:
-            if item == "p":
-                items.append(obj[item])
-            elif item == "ul" or item == "li":
-                items.append(get_text(obj[item]))
-            elif item == "table":
-                print("Table inside list")
-        return " ".join(items)
-
-
-def cycle_elem(doc, obj, indent=0, paragraph=None):
-    if type(obj) is list:
-        cycle_elem(doc, obj[0], indent, paragraph)
+        tag, value = obj
+        if tag == TAG_P:
+            yield value
+        elif tag == TAG_UL or tag == TAG_LI:
+            yield from _iter_text(value)
+        elif tag == TAG_TABLE:
+            print("Table inside list")
+
+
+@lru_cache(maxsize=4096)
+def _cached_text(node):
+    return " ".join(_iter_text(node))
+
+
+def get_text(obj):
+    # Zoning tables repeat literal cells like (TAG_P, "yes") constantly, so
+    # memoise on the hashable tagged tuples; nodes whose payload contains a
+    # list are not hashable and take the uncached path
+    if isinstance(obj, tuple):
+        try:
+            return _cached_text(obj)
+        except TypeError:
+            pass
+    # One join over a flat stream of leaf strings, instead of building an
+    # intermediate list per nesting level
+    return " ".join(_iter_text(obj))
+
+
+def cycle_elem(doc, obj, styles, indent=0, paragraph=None):
+    if isinstance(obj, list):
+        cycle_elem(doc, obj[0], styles, indent, paragraph)
         for item in obj[1:]:
-            cycle_elem(doc, item, indent=indent)
+            cycle_elem(doc, item, styles, indent=indent)
     else:
-        parse_elem(doc, obj, indent, paragraph)
+        parse_elem(doc, obj, styles, indent, paragraph)
 
 
-def parse_elem(doc, obj, indent=0, paragraph=None):
-    if "p" in obj.keys():
+def parse_elem(doc, obj, styles, indent=0, paragraph=None):
+    tag, value = obj
+    if tag == TAG_P:
         if paragraph is not None:
-            paragraph.add_run(obj["p"])
+            paragraph.add_run(value)
         else:
-            doc.add_paragraph(obj["p"])
-    elif "ul" in obj.keys():
-        for elem in obj["ul"]:
-            doc = parse_elem(doc, elem, indent)
-    elif "li" in obj.keys():
-        styles = ["List Bullet", "List Bullet 2", "List Bullet 3"]
-        if indent >= len(styles):
+            doc.add_paragraph(value)
+    elif tag == TAG_UL:
+        for elem in value:
+            doc = parse_elem(doc, elem, styles, indent)
+    elif tag == TAG_LI:
+        bullets = styles["bullets"]
+        if indent >= len(bullets):
             print(f"Indent level {indent} not supported")
-            style = styles[-1]
+            style = bullets[-1]
         else:
-            style = styles[indent]
+            style = bullets[indent]
 
         paragraph = doc.add_paragraph("", style=style)
-        cycle_elem(doc, obj["li"], indent=indent + 1, paragraph=paragraph)
-    elif "table" in obj.keys():
-        if "caption" in obj["table"].keys():
-            doc.add_heading(obj["table"]["caption"], level=4)
-        row_num, col_num = len(obj["table"]["body"]) + 1, len(obj["table"]["header"])
+        cycle_elem(doc, value, styles, indent=indent + 1, paragraph=paragraph)
+    elif tag == TAG_TABLE:
+        if "caption" in value:
+            doc.add_paragraph(value["caption"], style=styles["headings"][4])
+        header, body = value["header"], value["body"]
+        row_num, col_num = len(body) + 1, len(header)
         table = doc.add_table(rows=row_num, cols=col_num)
+        # Subscripting table.rows[...].cells[...] rebuilds the proxy objects
+        # and rescans the table XML each time, so materialise the grid once
+        cell_grid = [list(table_row.cells) for table_row in table.rows]
         for row in range(row_num):
             for cell in range(col_num):
                 if row == 0:
-                    table.rows[row].cells[cell].text = get_text(obj["table"]["header"][cell])
+                    cell_grid[row][cell].text = get_text(header[cell])
                 else:
-                    if len(obj["table"]["body"]) > row - 1 and len(obj["table"]["body"][row - 1]) > cell:
-                        paragraph = table.rows[row].cells[cell].paragraphs[0]
-                        cycle_elem(table.rows[row].cells[cell], obj["table"]["body"][row - 1][cell], indent, paragraph)
-        table.style = "LightShading-Accent1"
+                    if len(body) > row - 1 and len(body[row - 1]) > cell:
+                        paragraph = cell_grid[row][cell].paragraphs[0]
+                        cycle_elem(cell_grid[row][cell], body[row - 1][cell], styles, indent, paragraph)
+        table.style = styles["table"]
 
-        # print(obj["table"])
+        # print(value)
 
     return doc
 
 
 def md(content):
     env = Environment(loader=PackageLoader("App"), autoescape=select_autoescape())
+    env.globals.update(TAG_P=TAG_P, TAG_UL=TAG_UL, TAG_LI=TAG_LI, TAG_TABLE=TAG_TABLE)
     template = env.get_template("template.md")
     render = template.render(content)
     with open("output.md", "w") as f:
@@ -310,16 +272,11 @@ def md(content):
 if __name__ == "__main__":
     planning = Planning("32 RESIDENTIAL ZONES", "32.08 GENERAL RESIDENTIAL ZONE")
 
-    # with open("dump2.json", "w") as f:
-    #    json.dump(planning.renderOrdinance(), f)
-
     planning.parseOrdinance()
     # print(json.dumps(planning.ordinance_sections))
     docx(planning.ordinance_sections)
 
-    # content = {"subdivisions": planning.renderOrdinance()}
-
     # with MailMerge("planning_report.docx") as doc:
     #    print(doc.get_merge_fields())
 
-    # md(content)
+    # planning.renderOrdinance()
@@ -0,0 +1,138 @@
+"""Ordinance HTML parsing helpers.
+
+Split out of main.py with full type annotations so the hot recursive walk
+can be compiled to a C extension with mypyc (needs mypy installed, which
+is not part of requirements.txt):
+
+    pip install mypy
+    python setup.py build_ext --inplace
+
+The pure-Python module works as-is when the extension is not built.
+"""
+from typing import Any, Callable, Dict, Final, List, Optional, Tuple
+
+from selectolax.lexbor import LexborNode
+
+# Parsed nodes are (tag, payload) tuples - a tagged union is far cheaper to
+# allocate and dispatch on than a one-key dict per node
+TAG_P: Final = 0
+TAG_UL: Final = 1
+TAG_LI: Final = 2
+TAG_TABLE: Final = 3
+
+# Bump when the shape of the parsed structures changes (or a parser bug has
+# written bad entries), so stale disk-cached parses are not reused
+PARSE_FORMAT: Final = 3
+
+
+def _parse_children(elem: LexborNode) -> Any:
+    # Most cells hold exactly one child, so defer the list allocation until
+    # a second child actually turns up
+    first: Any = None
+    rest: Optional[List[Any]] = None
+    for cell_child in elem.iter(include_text=False):
+        sub_child = parse_elem(cell_child)
+        if sub_child:
+            if first is None:
+                first = sub_child
+            elif rest is None:
+                rest = [first, sub_child]
+            else:
+                rest.append(sub_child)
+    return first if rest is None else rest
+
+
+def _parse_ul(elem: LexborNode) -> Tuple[int, Any]:
+    points: List[Tuple[int, Any]] = []
+    for point in elem.iter(include_text=False):
+        if point.tag == "li":
+            sub_points = _parse_children(point)
+            if sub_points:
+                points.append((TAG_LI, sub_points))
+    return (TAG_UL, points)
+
+
+def _parse_table(elem: LexborNode) -> Tuple[int, Any]:
+    # Single streaming pass over the table subtree; CSS selectors would
+    # re-scan it once per row
+    table: Dict[str, Any] = {"header": [], "body": []}
+    # Only the first row of the first tbody is the header; later tbody
+    # elements contribute body rows
+    header_row = True
+    for child in elem.iter(include_text=False):
+        if child.tag == "caption":
+            table["caption"] = child.text(deep=True)
+        elif child.tag == "tbody":
+            for row in child.iter(include_text=False):
+                if row.tag != "tr":
+                    continue
+                if header_row:
+                    header_row = False
+                    table["header"] = [
+                        sub_points
+                        for col in row.iter(include_text=False)
+                        if col.tag == "th" and (sub_points := _parse_children(col))
+                    ]
+                else:
+                    table["body"].append(
+                        [
+                            sub_points
+                            for col in row.iter(include_text=False)
+                            if col.tag == "td" and (sub_points := _parse_children(col))
+                        ]
+                    )
+    return (TAG_TABLE, table)
+
+
+def _parse_p(elem: LexborNode) -> Optional[Tuple[int, Any]]:
+    text = elem.text(deep=True)
+    if not text == "":
+        return (TAG_P, text)
+    return None
+
+
+def _parse_br(elem: LexborNode) -> None:
+    return None
+
+
+# Tag dispatch table; one dict lookup replaces an if/elif chain in the
+# innermost parse loop
+_ELEM_HANDLERS: Dict[str, Callable[[LexborNode], Any]] = {
+    "ul": _parse_ul,
+    "table": _parse_table,
+    "p": _parse_p,
+    "br": _parse_br,
+}
+
+
+def parse_elem(elem: LexborNode) -> Any:
+    handler = _ELEM_HANDLERS.get(elem.tag or "")
+    if handler is not None:
+        return handler(elem)
+    else:
+        print(f"Unknown tag: {elem.html}")
+        return elem.text(deep=True)
+
+
+def parse_ord_section(body: LexborNode) -> Optional[List[Dict[str, Any]]]:
+    rules: List[Dict[str, Any]] = []
+    current_rule: Dict[str, Any] = {"content": []}
+    for child in body.iter(include_text=False):
+        if child.tag == "h3":
+            if len(current_rule["content"]) > 0:
+                rules.append(current_rule)
+                current_rule = {"content": []}
+            current_rule["title"] = child.text(deep=True)
+        else:
+            content = parse_elem(child)
+            if content:
+                current_rule["content"].append(content)
+
+    if len(current_rule["content"]) > 0:
+        rules.append(current_rule)
+
+    if rules:
+        return rules
+    else:
+        print("Failed to find rule")
+        return None
@@ -0,0 +1,11 @@
+from setuptools import setup
+from mypyc.build import mypycify
+
+# Optional: compile the ordinance parser to a C extension.
+# Requires mypy (pip install mypy), which is deliberately not in
+# requirements.txt since it is only needed for this build.
+# Build in place with: python setup.py build_ext --inplace
+setup(
+    name="vic-planning-provisions",
+    ext_modules=mypycify(["parser_ext.py"]),
+)